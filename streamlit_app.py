@@ -1,9 +1,16 @@
 import streamlit as st
-import yfinance as yf
-from datetime import datetime, timedelta
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import logging
+import math
 import os
+import re
+import threading
 import time
-import google.generativeai as genai
+
+logger = logging.getLogger(__name__)
 
 # ============================================
 # CALMTRADER - AI INVESTMENT COACH v2.0
@@ -25,13 +32,40 @@ st.set_page_config(
 if 'question_count' not in st.session_state:
     st.session_state.question_count = 0
 
-if 'last_question_time' not in st.session_state:
-    st.session_state.last_question_time = 0
+if 'tokens_in' not in st.session_state:
+    st.session_state.tokens_in = 0
+    st.session_state.tokens_out = 0
 
 # Free tier limits
 FREE_QUESTIONS_PER_SESSION = 3
 COOLDOWN_SECONDS = 10
 
+# Questions the whole app may send to Gemini per COOLDOWN_SECONDS, across all sessions
+SHARED_QUESTIONS_PER_COOLDOWN = 5
+
+# Cache lifetimes (seconds)
+PRICE_CACHE_TTL = 300
+META_CACHE_TTL = 24 * 60 * 60
+ADVICE_CACHE_TTL = 15 * 60
+
+# Pauses before each retry of a Yahoo call that failed on the network
+RETRY_DELAYS = (0.25, 0.75)
+
+# Smallest Yahoo history period that covers a lookback of N calendar days
+HISTORY_PERIODS = [(7, "5d"), (31, "1mo"), (92, "3mo"), (183, "6mo"), (366, "1y"), (731, "2y"), (1827, "5y")]
+
+# Anything in the portfolio text that looks like a ticker symbol
+TICKER_PATTERN = re.compile(r'\b[A-Z]{1,5}\b')
+
+# Capitalized words that turn up in portfolio notes but aren't holdings
+NOT_TICKERS = frozenset({
+    "A", "I", "AI", "ATH", "CEO", "DCA", "EPS", "ETF", "ETFS", "EV", "IMO",
+    "IPO", "IRA", "OK", "P", "ROTH", "S", "SP", "US", "USA", "USD", "YOLO",
+})
+
+# Deadline for a whole Gemini call, streamed or not (gRPC applies it to the full stream)
+REQUEST_TIMEOUT_SECONDS = 60
+
 # ============================================
 # SYSTEM PROMPT - Your Investment Philosophy
 # ============================================
@@ -63,43 +97,259 @@ Always end with: "What was your original reason for investing? Has that changed?
 # HELPER FUNCTIONS
 # ============================================
 
-def get_stock_data(ticker, days=7):
-    """Fetch recent stock data"""
-    try:
-        stock = yf.Ticker(ticker)
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=days+1)
-        hist = stock.history(start=start_date, end=end_date)
+# Set inside a cached function's body, so callers can tell a miss from a hit
+_cache_miss = contextvars.ContextVar("cache_miss", default=False)
+
+class _CacheStats:
+    """Hit/miss counts for the st.cache_data helpers, shared by every session"""
+    
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def record(self, missed):
+        with self.lock:
+            if missed:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+@st.cache_resource
+def _cache_stats():
+    """One set of cache counters for the whole process"""
+    return _CacheStats()
+
+def _track_cache(fn):
+    """Count hits and misses of a cached function whose body sets _cache_miss"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _cache_miss.set(False)
+        try:
+            result = fn(*args, **kwargs)
+            missed = _cache_miss.get()
+        except Exception:
+            # st.cache_data never stores a failure, so it always counts as a miss
+            _cache_stats().record(True)
+            raise
+        finally:
+            _cache_miss.reset(token)
         
-        if hist.empty:
-            return None
-            
-        info = stock.info
+        _cache_stats().record(missed)
+        
+        # Let an enclosing caller see that something was actually recomputed
+        if missed:
+            _cache_miss.set(True)
+        return result
+    return wrapper
+
+def _history_period(days):
+    """Map a lookback in calendar days to a Yahoo history period"""
+    for max_days, period in HISTORY_PERIODS:
+        if days <= max_days:
+            return period
+    return "max"
+
+def _yfinance():
+    """Import yfinance, set to raise errors instead of logging them"""
+    import yfinance as yf
+    
+    # Otherwise history() turns network failures into an empty frame
+    yf.config.debug.hide_exceptions = False
+    return yf
+
+def _yahoo_errors():
+    """Exceptions that mean a Yahoo lookup gave no usable data"""
+    from yfinance.exceptions import YFException
+    
+    return (YFException, OSError, KeyError, IndexError, ValueError)
+
+def _summarize_hist(hist):
+    """Reduce a price-history DataFrame to the plain floats the app shows"""
+    import numpy as np
+    
+    closes = hist['Close'].to_numpy()
+    highs = hist['High'].to_numpy()
+    lows = hist['Low'].to_numpy()
+    
+    current_price = float(closes[-1])
+    week_ago_price = float(closes[0])
+    week_change_percent = (current_price - week_ago_price) / week_ago_price * 100.0
+    
+    return {
+        'current_price': current_price,
+        'week_change_percent': week_change_percent,
+        'week_high': float(np.nanmax(highs)),
+        'week_low': float(np.nanmin(lows)),
+    }
+
+@_track_cache
+@st.cache_data(ttl=PRICE_CACHE_TTL, show_spinner=False)
+def _fetch_hist(ticker, days):
+    """Fetch recent price history, reduced to plain floats so it caches cheaply"""
+    yf = _yfinance()
+    
+    _cache_miss.set(True)
+    hist = yf.Ticker(ticker).history(
+        period=_history_period(days),
+        interval="1d",
+        actions=False,
+        auto_adjust=False,
+    )
+    
+    # Raise rather than return None, so an empty (often failed) download isn't cached
+    if hist.empty:
+        raise ValueError(f"No price history for {ticker}")
+    
+    return _summarize_hist(hist)
+
+@_track_cache
+@st.cache_data(ttl=PRICE_CACHE_TTL, show_spinner=False)
+def _fetch_portfolio_hist(tickers, days):
+    """Fetch recent prices for several tickers in one threaded download"""
+    yf = _yfinance()
+    
+    _cache_miss.set(True)
+    hist = yf.Tickers(" ".join(tickers)).history(
+        period=_history_period(days),
+        interval="1d",
+        actions=False,
+        auto_adjust=False,
+        group_by='ticker',
+        threads=True,
+        progress=False,
+    )
+    
+    # Failures show up as missing or empty tickers; raise so a partial batch isn't cached
+    prices = {}
+    for ticker in tickers:
+        if ticker not in hist.columns.get_level_values(0):
+            raise ValueError(f"No price history for {ticker}")
         
-        current_price = hist['Close'].iloc[-1]
-        week_ago_price = hist['Close'].iloc[0]
-        week_change_percent = ((current_price - week_ago_price) / week_ago_price) * 100
+        ticker_hist = hist[ticker].dropna(how='all')
+        if ticker_hist.empty:
+            raise ValueError(f"No price history for {ticker}")
+        prices[ticker] = _summarize_hist(ticker_hist)
+    
+    return prices
+
+def _portfolio_tickers(portfolio_input):
+    """Pull the ticker-looking words out of the portfolio description"""
+    words = set(TICKER_PATTERN.findall(portfolio_input or ""))
+    return tuple(sorted(words - NOT_TICKERS))
+
+@_track_cache
+@st.cache_data(ttl=META_CACHE_TTL, show_spinner=False)
+def _fetch_meta(ticker):
+    """Fetch company name and sector (these almost never change)
+    
+    Ticker.fast_info doesn't carry either field, so this is the one place
+    that still pays for the slow Ticker.info lookup.
+    """
+    yf = _yfinance()
+    
+    _cache_miss.set(True)
+    info = yf.Ticker(ticker).info
+    return {
+        'company_name': info.get('longName', ticker),
+        'sector': info.get('sector', 'Unknown'),
+    }
+
+def _with_retry(fetch, *args):
+    """Call a Yahoo fetch, retrying transient network errors with backoff"""
+    for delay in RETRY_DELAYS:
+        try:
+            return fetch(*args)
+        # Network failures only (curl_cffi's errors are OSErrors); YFException,
+        # including Yahoo's rate limit, is not worth retrying straight away
+        except OSError as e:
+            logger.warning("Yahoo request failed (%s), retrying in %.2fs", e, delay)
+            time.sleep(delay)
+    return fetch(*args)
+
+def _fetch_prices(ticker, days, portfolio_tickers):
+    """Look the ticker up in the portfolio batch, or fetch it on its own"""
+    if ticker in portfolio_tickers:
+        try:
+            return _fetch_portfolio_hist(portfolio_tickers, days)[ticker]
+        except _yahoo_errors() as e:
+            logger.warning("Portfolio batch failed (%s), fetching %s alone", e, ticker)
+    return _with_retry(_fetch_hist, ticker, days)
+
+@st.cache_resource
+def _meta_executor():
+    """Worker threads for company-info lookups, shared by every session"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="meta")
+
+def get_stock_data(ticker, days=7, portfolio_tickers=()):
+    """Fetch recent stock data
+    
+    Tickers listed in portfolio_tickers are fetched together in one batch,
+    so checking them one after another only hits Yahoo once.
+    """
+    ticker = ticker.upper()
+    ctx = get_script_run_ctx()
+    
+    def fetch_meta():
+        add_script_run_ctx(ctx=ctx)
+        return _with_retry(_fetch_meta, ticker)
+    
+    try:
+        # Prices and company info are separate Yahoo round trips, so overlap them
+        meta_future = _meta_executor().submit(fetch_meta)
+        try:
+            prices = _fetch_prices(ticker, days, portfolio_tickers)
+        except BaseException:
+            # No prices means no answer; don't make the user wait for the info lookup
+            meta_future.cancel()
+            raise
+        meta = meta_future.result()
         
         return {
-            'ticker': ticker.upper(),
-            'company_name': info.get('longName', ticker),
-            'current_price': current_price,
-            'week_change_percent': week_change_percent,
-            'week_high': hist['High'].max(),
-            'week_low': hist['Low'].min(),
-            'sector': info.get('sector', 'Unknown'),
+            'ticker': ticker,
+            **meta,
+            **prices,
         }
-    except:
+    except _yahoo_errors() as e:
+        logger.warning("Couldn't fetch data for %s: %s", ticker, e)
         return None
 
-def check_rate_limit():
-    """Check if user has hit rate limit"""
-    current_time = time.time()
-    time_since_last = current_time - st.session_state.last_question_time
+class _TokenBucket:
+    """Rate limiter shared by every session in this process"""
+    
+    def __init__(self, capacity, refill_seconds):
+        self.capacity = capacity
+        self.rate = capacity / refill_seconds
+        self.tokens = capacity
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def take(self):
+        """Take a token, returning (ok, seconds until one is available)"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+            
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True, 0
+            return False, (1 - self.tokens) / self.rate
     
-    if time_since_last < COOLDOWN_SECONDS:
-        return False, int(COOLDOWN_SECONDS - time_since_last)
-    return True, 0
+    def give_back(self):
+        """Return a token that ended up not being spent"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+@st.cache_resource
+def _rate_bucket():
+    """One bucket for the whole process, so extra tabs don't multiply the quota"""
+    return _TokenBucket(SHARED_QUESTIONS_PER_COOLDOWN, COOLDOWN_SECONDS)
+
+def check_rate_limit():
+    """Check if the app has hit its shared rate limit"""
+    can_proceed, wait_time = _rate_bucket().take()
+    return can_proceed, math.ceil(wait_time)
 
 def check_usage_limit():
     """Check if user has exceeded free tier limit"""
@@ -107,52 +357,166 @@ def check_usage_limit():
         return False
     return True
 
-def get_ai_advice(portfolio_context, user_question, stock_data=None):
-    """Get calm, rational advice from Gemini AI"""
+@st.cache_resource
+def _counter_lock():
+    """Serializes question-count updates from concurrent reruns"""
+    return threading.Lock()
+
+def _reserve_question():
+    """Claim one of this session's free questions, or return False if none are left"""
+    with _counter_lock():
+        if not check_usage_limit():
+            return False
+        st.session_state.question_count += 1
+        return True
+
+def _release_question():
+    """Give back a question that didn't end up getting an answer"""
+    with _counter_lock():
+        st.session_state.question_count -= 1
+
+@st.cache_resource
+def _model():
+    """Create the Gemini model once and share it across reruns and sessions"""
+    import google.generativeai as genai
+    
+    # gRPC multiplexes every call over one long-lived HTTP/2 connection
+    genai.configure(api_key=os.environ["GOOGLE_API_KEY"], transport="grpc")
+    return genai.GenerativeModel('gemini-1.5-flash', system_instruction=SYSTEM_PROMPT)
+
+@_track_cache
+@st.cache_data(ttl=ADVICE_CACHE_TTL, show_spinner=False)
+def _cached_advice(system_prompt, context):
+    """Get a complete answer from Gemini, reused for identical questions
+    
+    The system prompt is already baked into the model; it is passed here so
+    a prompt change invalidates cached answers.
+    """
+    _cache_miss.set(True)
+    response = _model().generate_content(
+        context,
+        request_options={"timeout": REQUEST_TIMEOUT_SECONDS},
+    )
+    return {
+        'text': response.text,
+        'input_tokens': response.usage_metadata.prompt_token_count,
+        'output_tokens': response.usage_metadata.candidates_token_count,
+    }
+
+def _record_usage(input_tokens, output_tokens):
+    """Add a Gemini call's token counts to this session's totals"""
+    st.session_state.tokens_in += input_tokens or 0
+    st.session_state.tokens_out += output_tokens or 0
+
+def _complete_advice(context):
+    """Return the whole answer at once, only charging questions that reach Gemini"""
+    token = _cache_miss.set(False)
+    try:
+        advice = _cached_advice(SYSTEM_PROMPT, context)
+        
+        # Update tracking; a cached answer doesn't use up a question or the rate limit
+        if _cache_miss.get():
+            _record_usage(advice['input_tokens'], advice['output_tokens'])
+        else:
+            _release_question()
+            _rate_bucket().give_back()
+        
+        return advice['text']
+    except Exception as e:
+        _release_question()
+        return f"⚠️ Error getting advice: {str(e)}"
+    finally:
+        _cache_miss.reset(token)
+
+def _advice_chunks(response, chunks, first_text):
+    """Yield the text of a Gemini stream that has already produced its first chunk"""
+    completed = False
+    try:
+        yield first_text
+        for chunk in chunks:
+            yield chunk.text
+        completed = True
+    finally:
+        # Also runs on a mid-stream error, or when a rerun closes the generator
+        if not completed:
+            _release_question()
+    
+    # Update tracking once the full answer has arrived
+    _record_usage(
+        response.usage_metadata.prompt_token_count,
+        response.usage_metadata.candidates_token_count,
+    )
+
+def _stream_advice(model, context):
+    """Start streaming an answer from Gemini
+    
+    The first chunk is fetched before returning, so a call that fails
+    outright comes back as a message string rather than as the answer.
+    """
+    try:
+        response = model.generate_content(
+            context,
+            stream=True,
+            request_options={"timeout": REQUEST_TIMEOUT_SECONDS},
+        )
+        chunks = iter(response)
+        first_text = next(chunks).text
+    except Exception as e:
+        _release_question()
+        return f"⚠️ Error getting advice: {str(e)}"
+    
+    return _advice_chunks(response, chunks, first_text)
+
+def get_ai_advice(portfolio_context, user_question, stock_data=None, stream=True):
+    """Get calm, rational advice from Gemini AI
     
-    # Check usage limit
-    if not check_usage_limit():
+    Returns a generator streaming the answer (or, with stream=False, the
+    finished answer as a string), or a message string if the question can't
+    be asked right now.
+    """
+    
+    # Check usage limit, reserving a question up front so a double click
+    # can't slip past the cap; it's given back if no answer comes of it
+    if not _reserve_question():
         return None
     
     # Check rate limit
     can_proceed, wait_time = check_rate_limit()
     if not can_proceed:
+        _release_question()
         return f"⏳ Please wait {wait_time} seconds before asking another question."
     
     # Check for API key
     api_key = os.environ.get("GOOGLE_API_KEY")
     if not api_key:
+        _release_question()
+        _rate_bucket().give_back()
         return "⚠️ API key not configured. Please contact support."
     
-    try:
-        # Configure Gemini
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        # Build context
-        context = f"{SYSTEM_PROMPT}\n\n"
-        context += f"User's Portfolio Context: {portfolio_context}\n\n"
-        context += f"User's Question: {user_question}\n\n"
-        
-        if stock_data:
-            context += f"Current Market Data:\n"
-            context += f"- {stock_data['company_name']} ({stock_data['ticker']})\n"
-            context += f"- Current Price: ${stock_data['current_price']:.2f}\n"
-            context += f"- Week Change: {stock_data['week_change_percent']:+.2f}%\n"
-            context += f"- Week Range: ${stock_data['week_low']:.2f} - ${stock_data['week_high']:.2f}\n"
-            context += f"- Sector: {stock_data['sector']}\n"
-        
-        # Call Gemini
-        response = model.generate_content(context)
-        
-        # Update tracking
-        st.session_state.question_count += 1
-        st.session_state.last_question_time = time.time()
-        
-        return response.text
-        
-    except Exception as e:
-        return f"⚠️ Error getting advice: {str(e)}"
+    # Build context
+    lines = [
+        f"User's Portfolio Context: {portfolio_context}",
+        "",
+        f"User's Question: {user_question}",
+        "",
+    ]
+    
+    if stock_data:
+        lines += [
+            "Current Market Data:",
+            f"- {stock_data['company_name']} ({stock_data['ticker']})",
+            f"- Current Price: ${stock_data['current_price']:.2f}",
+            f"- Week Change: {stock_data['week_change_percent']:+.2f}%",
+            f"- Week Range: ${stock_data['week_low']:.2f} - ${stock_data['week_high']:.2f}",
+            f"- Sector: {stock_data['sector']}",
+        ]
+    
+    context = "\n".join(lines)
+    
+    # Call Gemini
+    if not stream:
+        return _complete_advice(context)
+    return _stream_advice(_model(), context)
 
 # ============================================
 # STREAMLIT UI
@@ -214,13 +578,17 @@ with tab1:
     st.header("Ask Your Investment Coach")
     st.markdown("Feeling anxious about a position? Not sure what to do? Ask me.")
     
-    user_question = st.text_area(
-        "What's on your mind?",
-        placeholder="Example: NVDA just dropped 10%. Should I sell? I'm worried about...",
-        height=100
-    )
+    # A form only reruns the script on submit, not on every edit
+    with st.form("ask_form", clear_on_submit=False):
+        user_question = st.text_area(
+            "What's on your mind?",
+            placeholder="Example: NVDA just dropped 10%. Should I sell? I'm worried about...",
+            height=100
+        )
+        
+        ask_button = st.form_submit_button("Get Calm Advice", type="primary", disabled=not check_usage_limit())
     
-    if st.button("Get Calm Advice", type="primary", disabled=not check_usage_limit()):
+    if ask_button:
         if not portfolio_input:
             st.warning("⚠️ Please tell me about your portfolio in the sidebar first!")
         elif not user_question:
@@ -234,9 +602,12 @@ with tab1:
                 advice = get_ai_advice(context, user_question)
                 
                 # Display
-                if advice and not advice.startswith("⏳") and not advice.startswith("⚠️"):
+                if advice and not isinstance(advice, str):
                     st.success("Here's my take:")
-                    st.markdown(advice)
+                    try:
+                        st.write_stream(advice)
+                    except Exception as e:
+                        st.error(f"⚠️ The answer was cut off: {str(e)}")
                     
                     # Show feedback prompt
                     if st.session_state.question_count >= FREE_QUESTIONS_PER_SESSION:
@@ -248,20 +619,21 @@ with tab2:
     st.header("Quick Stock Check")
     st.markdown("Get a calm analysis of any stock in your portfolio.")
     
-    col1, col2 = st.columns([2, 1])
-    
-    with col1:
-        ticker = st.text_input("Enter Stock Ticker", placeholder="AAPL").upper()
-    
-    with col2:
-        st.write("")  # Spacing
-        st.write("")  # Spacing
-        check_button = st.button("Check Stock", type="primary", disabled=not check_usage_limit())
+    with st.form("check_form", clear_on_submit=False):
+        col1, col2 = st.columns([2, 1])
+        
+        with col1:
+            ticker = st.text_input("Enter Stock Ticker", placeholder="AAPL").upper()
+        
+        with col2:
+            st.write("")  # Spacing
+            st.write("")  # Spacing
+            check_button = st.form_submit_button("Check Stock", type="primary", disabled=not check_usage_limit())
     
     if check_button and ticker:
         with st.spinner(f"Analyzing {ticker}..."):
             # Get stock data
-            stock_data = get_stock_data(ticker)
+            stock_data = get_stock_data(ticker, portfolio_tickers=_portfolio_tickers(portfolio_input))
             
             if not stock_data:
                 st.error(f"❌ Couldn't find data for {ticker}. Check the ticker symbol.")
@@ -295,7 +667,7 @@ with tab2:
                     question = f"What should I know about {ticker}'s recent performance? Should I be concerned?"
                     
                     with st.spinner("Getting AI analysis..."):
-                        advice = get_ai_advice(context, question, stock_data)
+                        advice = get_ai_advice(context, question, stock_data, stream=False)
                         
                         if advice and not advice.startswith("⏳") and not advice.startswith("⚠️"):
                             st.markdown("### 🤖 AI Analysis")
@@ -305,6 +677,13 @@ with tab2:
                 else:
                     st.warning("⚠️ Add your portfolio info in the sidebar to get personalized analysis!")
 
+# Sidebar - Stats (rendered last so they include this run's work)
+with st.sidebar:
+    with st.expander("⚙️ Behind the scenes"):
+        stats = _cache_stats()
+        st.caption(f"Cache hits (all users): {stats.hits}/{stats.hits + stats.misses}")
+        st.caption(f"Tokens this session: {st.session_state.tokens_in:,} in / {st.session_state.tokens_out:,} out")
+
 # Footer
 st.divider()
 st.markdown("""